@@ -1,16 +1,21 @@
-import requests
+import asyncio
+import fcntl
+import json
 import logging
 import os
+import pickle
 import colorsys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from math import floor
+from string import Template
 import math
 
 from fasthtml.common import Div
 from fasthtml.common import P
 from fasthtml.common import fast_app
 from fasthtml.common import Iframe
-from fasthtml.common import FileResponse
 from fasthtml.common import Response
 from fasthtml.common import Titled
 from fasthtml.common import Container
@@ -23,14 +28,17 @@ import numpy as np
 from diskcache import Cache
 from dotenv import load_dotenv
 from googlemaps import Client as GoogleMaps
+import httpx
 
 import uvicorn
-from rasterio.transform import rowcol
+import rasterio
 
 logging.basicConfig(
     format="%(filename)s:%(lineno)d - %(message)s",
     level=logging.INFO
 )
+# httpx logs each request URL at INFO, and the geolocation URL carries the API key
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 
 load_dotenv()
@@ -46,9 +54,35 @@ app, rt = fast_app(
 DEBUG_COORDS = (27.95053694962414, -82.4585769277307)
 DEBUG_IP = "23.111.165.2"
 TILES_DIR = str(os.getenv("PROCESSED_DIR"))
+ELEVATION_DIR = str(os.getenv("INPUT_DIR"))  # Source DEM TIFs
+DEM_CACHE_DIR = "./cache/dem"  # Decoded rasters, memory-mapped when first read
+# Each decode holds a float32 copy of a whole raster, so keep only a few in flight
+DEM_DECODE_THREADS = min(4, os.cpu_count() or 1)
+# Each mapped DEM holds a file descriptor, so only this many stay open at once
+DEM_OPEN_LIMIT = 256
+# The tile walk is stat/scandir-bound, so a few threads overlap it even on one core
+TILE_WALK_THREADS = 8
+TILE_INDEX_SNAPSHOT = "./cache/tile_index.pkl"  # Saves the tile walk across restarts
+# Rasters are stored as whole metres in int16; this marks cells with no data
+NODATA = np.iinfo(np.int16).min
 # ALLOWED_ZOOM_LEVELS = [10, 11, 12, 13, 14, 15]
 ALLOWED_ZOOM_LEVELS = [8, 9]
+# Derived once so neither get_tile nor the map template redoes the work
+ALLOWED_ZOOM_SET = frozenset(ALLOWED_ZOOM_LEVELS)
+ALLOWED_ZOOMS_JS = json.dumps(ALLOWED_ZOOM_LEVELS)
+MIN_ZOOM = min(ALLOWED_ZOOM_LEVELS)
+MAX_ZOOM = max(ALLOWED_ZOOM_LEVELS)
+# x and y each get this many bits of a tile_key; enough for every tile up to z=15
+TILE_KEY_BITS = 15
+assert MAX_ZOOM <= TILE_KEY_BITS, "raise TILE_KEY_BITS to serve deeper zooms"
+# Re-tiling rewrites the same z/x/y paths, but tile URLs carry ?v=<tiles_version>,
+# which changes with the dataset, so the bytes behind any one URL never do
+TILE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# The map page only depends on its query, but elevation data can be reloaded
+MAP_CACHE_CONTROL = "public, max-age=3600"
 MAP_HEIGHT = "600px"
+# Each worker is a separate process with its own tile index and caches
+WORKERS = int(os.getenv("WORKERS", os.cpu_count() or 1))
 
 
 DEBUG_MODE = True
@@ -57,10 +91,18 @@ gmaps_api_key = os.environ.get("GMAP_API_KEY")
 assert gmaps_api_key is not None, "GMAP_API_KEY is not set"
 
 # Global variables to store the TIF data
-tif_data: list = []
+# Sidecar path and (height, width) per TIF; dem_band(i) maps the raster itself
+tif_npy_paths: list[str] = []
+tif_shapes: list[tuple[int, int]] = []
 tif_bounds: list = []
 tif_transform: list = []
-tile_index = {}
+# Inverse affine (a, b, c, d, e, f) per TIF, mapping lon/lat to col/row
+tif_inv_transform: list[tuple[float, ...]] = []
+# 1-degree (lat, lon) grid cell -> indices of the TIFs overlapping it
+tif_grid: dict[tuple[int, int], list[int]] = {}
+tile_index: dict[int, str] = {}
+# Identifies the tile dataset on disk; set with tile_index at startup
+tiles_version = ""
 
 
 @dataclass
@@ -74,8 +116,52 @@ class LocationInfo:
 
 gmaps = GoogleMaps(key=gmaps_api_key)
 
+# Shared async client so geolocation lookups reuse keep-alive connections
+http_client = httpx.AsyncClient(
+    timeout=5.0, limits=httpx.Limits(max_keepalive_connections=20)
+)
+# IP -> geolocation lookup currently in flight
+geolocation_inflight: dict[str, asyncio.Future] = {}
+
+
+def tile_key(z, x, y):
+    """Pack (z, x, y) into a single int key for tile_index."""
+    return (((z << TILE_KEY_BITS) | x) << TILE_KEY_BITS) | y
+
+
+def _numeric_subdirs(path):
+    """Yield (int(name), path) for each all-digit subdirectory of path."""
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.isdigit() and entry.is_dir():
+                yield int(entry.name), entry.path
+
+
+def _scan_x_dir(tif_dir, z, x, x_path):
+    """Index one {z}/{x} directory in a worker thread, into a dict of its own."""
+    tiles = {}
+    ys = []
+    with os.scandir(x_path) as it:
+        for entry in it:
+            stem = entry.name[:-4]
+            if not (entry.name.endswith(".png") and stem.isdigit()):
+                continue
+            # Answered from the dirent type, so this costs no stat per tile
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            y = int(stem)
+            # Store the full path so get_tile never has to build it
+            tiles[tile_key(z, x, y)] = entry.path
+            ys.append(y)
+
+    # Coverage check, gathered here so it doesn't need its own walk
+    if DEBUG_MODE and z == ALLOWED_ZOOM_LEVELS[0] and ys:
+        logging.info(f"TIF {tif_dir} at z={z}, x={x}: y={min(ys)}-{max(ys)}")
+    return tiles
+
 
 def preload_tile_paths():
+    """Map every (z, x, y) on disk to the path of its PNG."""
     tile_index = {}
     total_tiles = 0
     tif_counts = {}  # Track tiles per TIF directory
@@ -86,183 +172,422 @@ def preload_tile_paths():
         return tile_index
 
     logging.info(f"Loading tiles from: {TILES_DIR}")
-    tif_dirs = os.listdir(TILES_DIR)
-    logging.info(f"Found {len(tif_dirs)} TIF directories")
+    with os.scandir(TILES_DIR) as it:
+        tif_entries = [entry for entry in it if entry.is_dir()]
+    logging.info(f"Found {len(tif_entries)} TIF directories")
+
+    # process_tif.py writes one shared tiles/ tree, so the work to split is the
+    # x directories
+    x_dirs = []
+    for tif_entry in tif_entries:
+        tif_counts[tif_entry.name] = 0
+        for z, z_path in _numeric_subdirs(tif_entry.path):
+            # Other zooms are never served, and their keys may not fit
+            if z not in ALLOWED_ZOOM_SET:
+                continue
+            for x, x_path in _numeric_subdirs(z_path):
+                x_dirs.append((tif_entry.name, z, x, x_path))
+
+    # scandir releases the GIL, so the threads overlap the I/O. map() keeps
+    # listing order, so overlapping tiles resolve as a serial walk would.
+    with ThreadPoolExecutor(max_workers=TILE_WALK_THREADS) as pool:
+        scans = pool.map(lambda d: _scan_x_dir(*d), x_dirs)
+        for (tif_dir, *_), tiles in zip(x_dirs, scans):
+            tif_counts[tif_dir] += len(tiles)
+            total_tiles += len(tiles)
+            tile_index.update(tiles)
+    logging.info(f"Loaded {total_tiles:,} tiles from {len(tif_counts)} TIF files")
+    return tile_index
 
-    for tif_dir in os.listdir(TILES_DIR):
-        tif_path = os.path.join(TILES_DIR, tif_dir)
-        if not os.path.isdir(tif_path):
-            continue
 
-        tif_counts[tif_dir] = 0  # Initialize counter for this TIF
+def _tiles_stamp():
+    """mtimes of every directory down to {z}/{x}; adding or removing a tile changes one.
 
-        for z_dir in os.listdir(tif_path):
-            if not z_dir.isdigit():
+    Only served zooms are visited, so this is a few hundred stats, not one per tile.
+    """
+    dirs = []
+    with os.scandir(TILES_DIR) as it:
+        tif_entries = [e for e in it if e.is_dir()]
+    for tif_entry in tif_entries:
+        dirs.append((tif_entry.path, tif_entry.stat().st_mtime_ns))
+        for z, z_path in _numeric_subdirs(tif_entry.path):
+            if z not in ALLOWED_ZOOM_SET:
                 continue
-            z = int(z_dir)
-            if z not in tile_index:
-                tile_index[z] = {}
-
-            z_path = os.path.join(tif_path, z_dir)
-            for x_dir in os.listdir(z_path):
-                if not x_dir.isdigit():
-                    continue
-                x = int(x_dir)
-                if x not in tile_index[z]:
-                    tile_index[z][x] = {}
-
-                x_path = os.path.join(z_path, x_dir)
-                for file in os.listdir(x_path):
-                    if not file.endswith(".png"):
-                        continue
-                    y = int(file.replace(".png", ""))
-                    tile_index[z][x][y] = tif_dir
-                    total_tiles += 1
-                    tif_counts[tif_dir] += 1
-    logging.info(f"Loaded {total_tiles:,} tiles from {len(tif_counts)} TIF files")
+            dirs.append((z_path, os.stat(z_path).st_mtime_ns))
+            dirs.extend(
+                (x_path, os.stat(x_path).st_mtime_ns)
+                for _, x_path in _numeric_subdirs(z_path)
+            )
+    # The key layout and zoom filter are part of what the snapshot encodes
+    return (
+        TILE_KEY_BITS,
+        ALLOWED_ZOOM_LEVELS,
+        os.stat(TILES_DIR).st_mtime_ns,
+        sorted(dirs),
+    )
+
+
+def load_tile_index():
+    """tile_index from the on-disk snapshot if it is current, else walk and save one."""
+    global tiles_version
+    if not os.path.exists(TILES_DIR):
+        return preload_tile_paths()
+
+    stamp = _tiles_stamp()
+    # process_tif.py deletes and rewrites the tree, so a new dataset has newer
+    # directories
+    *_, root_mtime, dirs = stamp
+    tiles_version = f"{max([root_mtime, *(mtime for _, mtime in dirs)]):x}"
+    try:
+        with open(TILE_INDEX_SNAPSHOT, "rb") as f:
+            snapshot = pickle.load(f)
+        if snapshot["stamp"] == stamp:
+            logging.info(
+                f"Loaded {len(snapshot['tiles']):,} tiles from {TILE_INDEX_SNAPSHOT}"
+            )
+            return snapshot["tiles"]
+    # A snapshot from an older layout can unpickle into the wrong shape
+    except (
+        OSError,
+        EOFError,
+        pickle.UnpicklingError,
+        KeyError,
+        TypeError,
+        ValueError,
+        AttributeError,
+    ):
+        pass
+
+    tile_index = preload_tile_paths()
+    os.makedirs(os.path.dirname(TILE_INDEX_SNAPSHOT), exist_ok=True)
+    tmp_path = f"{TILE_INDEX_SNAPSHOT}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"stamp": stamp, "tiles": tile_index}, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, TILE_INDEX_SNAPSHOT)
     return tile_index
 
 
-tile_index = preload_tile_paths()
+def _write_dem_sidecar(tif_path, npy_path):
+    """Decode band 1 of a TIF to an int16 .npy file, atomically."""
+    with rasterio.open(tif_path) as src:
+        data = src.read(1).astype(np.float32, copy=False)
+        missing = np.isnan(data)
+        # DEMs often flag gaps with a value such as -32767 rather than NaN
+        if src.nodata is not None and not np.isnan(src.nodata):
+            missing |= data == src.nodata
+    # Whole metres are plenty for terrain and halve the bytes of float32.
+    # Converted in place, so a full-size SRTM tile costs one float copy, not five.
+    np.round(data, out=data)
+    np.clip(data, NODATA + 1, np.iinfo(np.int16).max, out=data)
+    data[missing] = NODATA
+    data = data.astype(np.int16)
+    # Write then rename, so other workers never map a half-written file
+    tmp_path = f"{npy_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, data)
+    os.replace(tmp_path, npy_path)
+
+
+def build_dem_sidecar(tif_path):
+    """Path of the TIF's int16 .npy sidecar, decoding it first if missing or stale."""
+    npy_path = os.path.join(
+        DEM_CACHE_DIR, os.path.basename(tif_path) + ".nodata.i16.npy"
+    )
+
+    def current():
+        exists = os.path.exists(npy_path)
+        return exists and os.path.getmtime(npy_path) >= os.path.getmtime(tif_path)
+
+    if not current():
+        os.makedirs(DEM_CACHE_DIR, exist_ok=True)
+        # Workers that start together wait for whichever one got here first
+        with open(npy_path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not current():
+                _write_dem_sidecar(tif_path, npy_path)
+    return npy_path
+
+
+@lru_cache(maxsize=DEM_OPEN_LIMIT)
+def dem_band(i):
+    """Band 1 of TIF i as a read-only int16 memmap, reopened if it was evicted."""
+    return np.load(tif_npy_paths[i], mmap_mode="r")
+
+
+def _elevation_tif_paths():
+    return [
+        os.path.join(ELEVATION_DIR, file)
+        for file in sorted(os.listdir(ELEVATION_DIR))
+        if file.endswith(".tif")
+    ]
+
+
+def prepare_dem_cache():
+    """Decode any missing sidecars once, before uvicorn starts its workers."""
+    if not os.path.exists(ELEVATION_DIR):
+        return
+    with ThreadPoolExecutor(max_workers=DEM_DECODE_THREADS) as pool:
+        list(pool.map(build_dem_sidecar, _elevation_tif_paths()))
+
+
+def _load_tif(tif_path):
+    """Bounds, transform, shape and sidecar path of one TIF."""
+    with rasterio.open(tif_path) as src:
+        src_bounds, src_transform = src.bounds, src.transform
+        shape = (src.height, src.width)
+    return src_bounds, src_transform, shape, build_dem_sidecar(tif_path)
+
+
+def load_tif_data():
+    """Index every elevation TIF in ELEVATION_DIR; rasters are mapped on first read."""
+    # Startup can run more than once per process (e.g. TestClient, reload)
+    tables = (tif_npy_paths, tif_shapes, tif_bounds, tif_transform, tif_inv_transform)
+    for table in (*tables, tif_grid):
+        table.clear()
+    dem_band.cache_clear()
+    if not os.path.exists(ELEVATION_DIR):
+        logging.warning(f"Elevation directory not found: {ELEVATION_DIR}")
+        return
+
+    # Sidecars normally exist by now (prepare_dem_cache); if not, the lock
+    # in build_dem_sidecar keeps workers from decoding the same TIF at once
+    with ThreadPoolExecutor(max_workers=DEM_DECODE_THREADS) as pool:
+        for src_bounds, src_transform, shape, npy_path in pool.map(
+            _load_tif, _elevation_tif_paths()
+        ):
+            tif_bounds.append(src_bounds)
+            tif_transform.append(src_transform)
+            tif_inv_transform.append(tuple(~src_transform)[:6])
+            tif_shapes.append(shape)
+            tif_npy_paths.append(npy_path)
+
+    # SRTM TIFs are 1-degree squares, so a point only has to check its own cell
+    for i, bounds in enumerate(tif_bounds):
+        for lat_cell in range(floor(bounds.bottom), floor(bounds.top) + 1):
+            for lon_cell in range(floor(bounds.left), floor(bounds.right) + 1):
+                tif_grid.setdefault((lat_cell, lon_cell), []).append(i)
+    logging.info(f"Loaded {len(tif_npy_paths)} elevation TIFs from {ELEVATION_DIR}")
+
+
+def load_data():
+    """Build the tile index and index the DEMs once the worker is up, not at import."""
+    global tile_index
+    tile_index = load_tile_index()
+    load_tif_data()
+
+
+app.router.on_startup.append(load_data)
+
+
+def pixel_index(i, latitude, longitude):
+    """Row and column of the point in TIF i, without rasterio's rowcol overhead."""
+    a, b, c, d, e, f = tif_inv_transform[i]
+    return (
+        floor(d * longitude + e * latitude + f),
+        floor(a * longitude + b * latitude + c),
+    )
+
+
+def find_tif(latitude, longitude):
+    """Index of the first TIF whose bounds contain the point, or None."""
+    for i in tif_grid.get((floor(latitude), floor(longitude)), ()):
+        bounds = tif_bounds[i]
+        if (
+            bounds.left <= longitude <= bounds.right
+            and bounds.bottom <= latitude <= bounds.top
+        ):
+            return i
+    return None
+
 
 def lat_lon_to_tile(lat, lon, zoom):
-    n = 2.0**zoom
+    n = 1 << zoom  # Exact for integer zooms, without a float pow
     xtile = floor((lon + 180.0) / 360.0 * n)
     ytile = floor((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
-    logging.info(
-        f"Converting lat={lat}, lon={lon}, zoom={zoom} to tile: x={xtile}, y={ytile}"
+    logging.debug(
+        "Converting lat=%s, lon=%s, zoom=%s to tile: x=%s, y=%s",
+        lat,
+        lon,
+        zoom,
+        xtile,
+        ytile,
     )
     return xtile, ytile
 
 
 def tile_to_lat_lon(x, y, zoom):
-    n = 2.0**zoom
+    n = 1 << zoom
     lon_deg = (x / n * 360.0) - 180.0
     lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * y / n)))
     lat_deg = math.degrees(lat_rad)
     return lat_deg, lon_deg
 
 
-# Add this debug code to verify tile coverage:
-z = ALLOWED_ZOOM_LEVELS[0]  # zoom level 8
-for tif_dir in os.listdir(TILES_DIR):
-    z_path = os.path.join(TILES_DIR, tif_dir, str(z))
-    if not os.path.exists(z_path):
-        continue
-        
-    x_dirs = [int(x) for x in os.listdir(z_path) if x.isdigit()]
-    if not x_dirs:
-        continue
-        
-    for x in x_dirs:
-        y_files = [int(y.replace('.png', '')) for y in os.listdir(os.path.join(z_path, str(x))) if y.endswith('.png')]
-        if y_files:
-            logging.info(f"TIF {tif_dir} at z={z}, x={x}: y={min(y_files)}-{max(y_files)}")
-
 def get_elevation_from_memory(latitude, longitude):
     # logging.info(f"Getting elevation for lat={latitude}, lon={longitude}")
-    for i, bounds in enumerate(tif_bounds):
-        if (
-            bounds.left <= longitude <= bounds.right
-            and bounds.bottom <= latitude <= bounds.top
-        ):
-            # Use rasterio's index function to get row, col
-            row, col = rowcol(tif_transform[i], longitude, latitude)
-            # logging.info(f"Calculated row={row}, col={col}")
-
-            # Convert row and col to integers
-            row, col = int(row), int(col)
-
-            # Check if row and col are within bounds
-            if 0 <= row < tif_data[i].shape[0] and 0 <= col < tif_data[i].shape[1]:
-                elevation = tif_data[i][row, col]
-                # logging.info(f"Elevation found: {elevation}")
-                return float(elevation)
-            else:
-                logging.warning(
-                    f"Calculated row or col out of bounds: row={row}, col={col}"
-                )
-                return None
-    logging.warning(f"No matching bounds found for lat={latitude}, lon={longitude}")
+    i = find_tif(latitude, longitude)
+    if i is None:
+        logging.warning(f"No matching bounds found for lat={latitude}, lon={longitude}")
+        return None
+
+    row, col = pixel_index(i, latitude, longitude)
+    # logging.info(f"Calculated row={row}, col={col}")
+
+    # Check if row and col are within bounds
+    height, width = tif_shapes[i]
+    if 0 <= row < height and 0 <= col < width:
+        elevation = int(dem_band(i)[row, col])
+        # logging.info(f"Elevation found: {elevation}")
+        return None if elevation == NODATA else float(elevation)
+
+    logging.warning(f"Calculated row or col out of bounds: row={row}, col={col}")
     return None
 
 
-def get_ip_geolocation(ip_address):
+def get_elevations_bulk(latitudes, longitudes):
+    """Elevations for arrays of points, NaN where there is no data.
+
+    Same lookup as get_elevation_from_memory, done once per TIF rather than once
+    per point.
+    """
+    lats = np.asarray(latitudes, dtype=np.float64)
+    lons = np.asarray(longitudes, dtype=np.float64)
+    out = np.full(lats.shape, np.nan)
+    todo = np.ones(lats.shape, dtype=bool)
+
+    # Only the TIFs filed under the points' grid cells can match, in find_tif's order
+    # Cells are packed as lat * 1024 + (lon + 512), so np.unique dedupes them without
+    # building a Python object per point; real longitudes keep the low part in range
+    finite = np.isfinite(lats) & np.isfinite(lons)
+    lat_cells = np.floor(lats[finite]).astype(np.int64)
+    lon_cells = np.floor(lons[finite]).astype(np.int64)
+    packed = np.unique(lat_cells * 1024 + (lon_cells + 512)).tolist()
+    candidates = sorted(
+        {i for key in packed for i in tif_grid.get((key // 1024, key % 1024 - 512), ())}
+    )
+
+    for i in candidates:
+        bounds = tif_bounds[i]
+        hit = (
+            todo
+            & (lons >= bounds.left)
+            & (lons <= bounds.right)
+            & (lats >= bounds.bottom)
+            & (lats <= bounds.top)
+        )
+        if not hit.any():
+            continue
+        # First matching TIF wins, as in find_tif, even if the pixel falls off its
+        # raster
+        todo &= ~hit
+
+        a, b, c, d, e, f = tif_inv_transform[i]
+        rows = np.floor(d * lons[hit] + e * lats[hit] + f).astype(np.intp)
+        cols = np.floor(a * lons[hit] + b * lats[hit] + c).astype(np.intp)
+        height, width = tif_shapes[i]
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+        values = np.full(rows.shape, np.nan)
+        elevations = dem_band(i)[rows[inside], cols[inside]]
+        values[inside] = np.where(elevations == NODATA, np.nan, elevations)
+        out[hit] = values
+    return out
+
+
+async def _fetch_ip_geolocation(ip_address):
     api_key = os.environ.get("IP2LOC_API_KEY")
     url = f"https://api.ip2location.io/?key={api_key}&ip={ip_address}&format=json"
 
     try:
-        response = requests.get(url)
+        response = await http_client.get(url)
         response.raise_for_status()
         return response.json()
-    except requests.RequestException as e:
+    # Unlike requests, httpx raises a plain ValueError for a non-JSON body
+    except (httpx.HTTPError, ValueError) as e:
         logging.error(f"Error fetching IP geolocation: {e}")
         return None
 
 
-# Update the get_elevation function
-def get_elevation(latitude, longitude):
-    cache_key = f"elevation_{latitude}_{longitude}"
-    cached_elevation = cache.get(cache_key)
-    if cached_elevation:
-        return cached_elevation
-
-    elevation = get_elevation_from_memory(latitude, longitude)
-    if elevation is not None:
-        cache.set(cache_key, elevation, expire=86400)  # Cache for 24 hours
-    return elevation
+async def get_ip_geolocation(ip_address):
+    """Look up an IP, sharing one upstream request between concurrent callers."""
+    task = geolocation_inflight.get(ip_address)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_ip_geolocation(ip_address))
+        geolocation_inflight[ip_address] = task
+        task.add_done_callback(lambda _: geolocation_inflight.pop(ip_address, None))
+    # Shield so one client disconnecting doesn't cancel the lookup for the rest
+    return await asyncio.shield(task)
 
 
-def get_elevation_data(center_lat, center_lng, radius=0.05):
-    """Get elevation data for a region around the center coordinates."""
-    for i, bounds in enumerate(tif_bounds):
-        if (
-            bounds.left <= center_lng <= bounds.right
-            and bounds.bottom <= center_lat <= bounds.top
-        ):
-            # Calculate the region of interest
-            min_lat, max_lat = center_lat - radius, center_lat + radius
-            min_lng, max_lng = center_lng - radius, center_lng + radius
+# A memmap read is far cheaper than a diskcache (SQLite) round trip, so only
+# memoize in-process
+_get_elevation_cached = lru_cache(maxsize=100_000)(get_elevation_from_memory)
 
-            # Convert lat/lon to row/col
-            row_min, col_min = map(int, rowcol(tif_transform[i], min_lng, max_lat))
-            row_max, col_max = map(int, rowcol(tif_transform[i], max_lng, min_lat))
 
-            # Ensure we're within bounds
-            row_min, row_max = max(0, row_min), min(tif_data[i].shape[0], row_max)
-            col_min, col_max = max(0, col_min), min(tif_data[i].shape[1], col_max)
+def get_elevation(latitude, longitude):
+    """Elevation at a point, cached in memory at ~1 m granularity."""
+    return _get_elevation_cached(round(latitude, 5), round(longitude, 5))
 
-            # Extract the data subset
-            data_subset = tif_data[i][row_min:row_max, col_min:col_max]
 
-            # Log statistics about the data subset
-            logging.info(
-                f"Elevation data stats: min={np.nanmin(data_subset):.2f}, "
-                f"max={np.nanmax(data_subset):.2f}, mean={np.nanmean(data_subset):.2f}, "
-                f"median={np.nanmedian(data_subset):.2f}"
-            )
-            logging.info(f"Data shape: {data_subset.shape}")
+def get_elevation_data(center_lat, center_lng, radius=0.05, step=1):
+    """Get elevation data for a region around the center coordinates.
 
-            # Create lat/lon arrays for the subset
-            lats = np.linspace(max_lat, min_lat, data_subset.shape[0])
-            lons = np.linspace(min_lng, max_lng, data_subset.shape[1])
-            lons, lats = np.meshgrid(lons, lats)
+    Returns (lats, lons, elevations) as 1-D arrays over the valid cells,
+    keeping every step-th row and column of the raster.
+    """
+    i = find_tif(center_lat, center_lng)
+    if i is None:
+        empty = np.empty(0)
+        return empty, empty, empty  # No matching TIF file found
+
+    # Calculate the region of interest
+    min_lat, max_lat = center_lat - radius, center_lat + radius
+    min_lng, max_lng = center_lng - radius, center_lng + radius
+
+    # Convert lat/lon to row/col
+    row_min, col_min = pixel_index(i, max_lat, min_lng)
+    row_max, col_max = pixel_index(i, min_lat, max_lng)
+
+    # Ensure we're within bounds
+    height, width = tif_shapes[i]
+    row_min, row_max = max(0, row_min), min(height, row_max)
+    col_min, col_max = max(0, col_min), min(width, col_max)
+
+    # Extract the data subset, thinning in 2-D so the sample stays a uniform grid
+    data_subset = dem_band(i)[row_min:row_max:step, col_min:col_max:step]
+
+    # Keep only valid cells and place them at their pixel centres
+    rows, cols = np.nonzero(data_subset != NODATA)
+    elevations = data_subset[rows, cols]
+
+    # The stats are diagnostics only, so skip their extra passes (and median's
+    # sort) otherwise
+    if elevations.size and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(
+            f"Elevation data stats: min={elevations.min():.2f}, "
+            f"max={elevations.max():.2f}, mean={elevations.mean():.2f}, "
+            f"median={np.median(elevations):.2f}"
+        )
+    logging.info(f"Data shape: {data_subset.shape}")
 
-            # Flatten and combine the data
-            result = list(zip(lats.flatten(), lons.flatten(), data_subset.flatten()))
-            return [point for point in result if not np.isnan(point[2])]
+    rows = rows * step + (row_min + 0.5)
+    cols = cols * step + (col_min + 0.5)
 
-    return []  # Return empty list if no matching TIF file found
+    transform = tif_transform[i]
+    lons = transform.a * cols + transform.b * rows + transform.c
+    lats = transform.d * cols + transform.e * rows + transform.f
+    return lats, lons, elevations
 
 
-def get_location_info(ip_address) -> LocationInfo:
+async def get_location_info(ip_address) -> LocationInfo:
     if DEBUG_MODE:
         return LocationInfo(
             "Tampa", "Florida", "United States", DEBUG_COORDS[0], DEBUG_COORDS[1]
         )
 
     cache_key = f"geo_{ip_address}"
-    cached_result = cache.get(cache_key)
+    # diskcache is SQLite; keep its blocking calls off the event loop
+    cached_result = await asyncio.to_thread(cache.get, cache_key)
     if cached_result and isinstance(cached_result, tuple) and len(cached_result) == 5:
         return LocationInfo(
             city=str(cached_result[0]),
@@ -272,7 +597,7 @@ def get_location_info(ip_address) -> LocationInfo:
             longitude=cached_result[4],
         )
 
-    geolocation_data = get_ip_geolocation(ip_address)
+    geolocation_data = await get_ip_geolocation(ip_address)
     if geolocation_data:
         info = LocationInfo(
             city=geolocation_data.get("city_name", "Unknown"),
@@ -281,7 +606,8 @@ def get_location_info(ip_address) -> LocationInfo:
             latitude=float(geolocation_data.get("latitude", 0)),
             longitude=float(geolocation_data.get("longitude", 0)),
         )
-        cache.set(
+        await asyncio.to_thread(
+            cache.set,
             cache_key,
             (info.city, info.region, info.country, info.latitude, info.longitude),
             expire=86400,
@@ -291,53 +617,77 @@ def get_location_info(ip_address) -> LocationInfo:
     return LocationInfo()
 
 
+COLOR_LUT_SIZE = 1024
+
+# RGB for values -1..1 in COLOR_LUT_SIZE steps, mapped to hue 240..0 (blue to red)
+COLOR_LUT = (
+    np.array(
+        [
+            colorsys.hsv_to_rgb((1 - i / (COLOR_LUT_SIZE - 1)) * 240 / 360, 1, 1)
+            for i in range(COLOR_LUT_SIZE)
+        ]
+    )
+    * 255
+).astype(np.uint8)
+# The same table as CSS strings, so get_color is a plain list index
+COLOR_CSS = [f"rgb({r}, {g}, {b})" for r, g, b in COLOR_LUT.tolist()]
+
+
 def get_color(value):
     """Convert a value between -1 and 1 to an RGB color."""
-    hue = (1 - (value + 1) / 2) * 240 / 360  # Map -1..1 to hue 240..0 (blue to red)
-    rgb = colorsys.hsv_to_rgb(hue, 1, 1)
-    return f"rgb({int(rgb[0]*255)}, {int(rgb[1]*255)}, {int(rgb[2]*255)})"
+    i = min(
+        COLOR_LUT_SIZE - 1, max(0, int((value + 1) * 0.5 * (COLOR_LUT_SIZE - 1) + 0.5))
+    )
+    return COLOR_CSS[i]
 
 
-def generate_gmaps_html(latitude, longitude, elevation):
-    tile_url_pattern = "/tiles/{z}/{x}/{y}"
+def get_color_batch(values):
+    """Convert an array of values between -1 and 1 to an (N, 3) uint8 RGB array."""
+    idx = ((np.asarray(values) + 1) * 0.5 * (COLOR_LUT_SIZE - 1) + 0.5).astype(np.int32)
+    return COLOR_LUT[idx.clip(0, COLOR_LUT_SIZE - 1)]
+
 
-    return f"""
+TILE_URL_PATTERN = "/tiles/{z}/{x}/{y}?v=$tiles_version"
+
+# Everything but the per-request location and the tile dataset version is baked
+# in once at import
+GMAPS_HTML_TEMPLATE = Template(f"""
     <div id="map" style="height: {MAP_HEIGHT}; width: 100%;"></div>
     <script src="https://maps.googleapis.com/maps/api/js?key={gmaps_api_key}"></script>
     <script>
         function initMap() {{
-            const allowedZoomLevels = {ALLOWED_ZOOM_LEVELS};
+            const allowedZoomLevels = {ALLOWED_ZOOMS_JS};
             const initialZoom = allowedZoomLevels[Math.floor(allowedZoomLevels.length / 2)];
 
             const map = new google.maps.Map(document.getElementById("map"), {{
-                center: {{ lat: {latitude}, lng: {longitude} }},
+                center: {{ lat: $lat, lng: $lng }},
                 zoom: initialZoom,
                 mapTypeId: "terrain",
                 zoomControl: true,
                 scrollwheel: true,
                 disableDoubleClickZoom: false,
                 draggable: true,
-                minZoom: Math.min(...allowedZoomLevels),
-                maxZoom: Math.max(...allowedZoomLevels),
+                minZoom: {MIN_ZOOM},
+                maxZoom: {MAX_ZOOM},
                 restriction: {{
                     latLngBounds: {{
-                        north: {latitude} + 0.1,
-                        south: {latitude} - 0.1,
-                        east: {longitude} + 0.1,
-                        west: {longitude} - 0.1,
+                        north: $lat + 0.1,
+                        south: $lat - 0.1,
+                        east: $lng + 0.1,
+                        west: $lng - 0.1,
                     }},
                     strictBounds: false,
                 }}
             }});
 
             const marker = new google.maps.Marker({{
-                position: {{ lat: {latitude}, lng: {longitude} }},
+                position: {{ lat: $lat, lng: $lng }},
                 map: map,
                 title: "Your location"
             }});
 
             const infowindow = new google.maps.InfoWindow({{
-                content: "Lat: {latitude}, Lon: {longitude}<br>Elevation: {elevation} m"
+                content: "Lat: $lat, Lon: $lng<br>Elevation: $elev m"
             }});
 
             marker.addListener("click", () => {{
@@ -347,7 +697,7 @@ def generate_gmaps_html(latitude, longitude, elevation):
             const tileLayer = new google.maps.ImageMapType({{
                 getTileUrl: function(coord, zoom) {{
                     if (allowedZoomLevels.includes(zoom)) {{
-                        return '{tile_url_pattern}'
+                        return '{TILE_URL_PATTERN}'
                             .replace('{{z}}', zoom)
                             .replace('{{x}}', coord.x)
                             .replace('{{y}}', coord.y);
@@ -363,42 +713,116 @@ def generate_gmaps_html(latitude, longitude, elevation):
         }}
     </script>
     <script>initMap();</script>
-    """
+    """)
 
 
-def create_map(latitude, longitude):
-    # cache_key = f"map_{latitude}_{longitude}"
-    # cached_map = cache.get(cache_key)
-    # if cached_map:
-    #     logging.info(f"Cache hit for map: {cache_key}")
-    #     return cached_map
+def generate_gmaps_html(latitude, longitude, elevation):
+    if elevation is None:
+        elevation = "Unknown"  # Worded as on the / page
+    return GMAPS_HTML_TEMPLATE.substitute(
+        lat=latitude, lng=longitude, elev=elevation, tiles_version=tiles_version
+    )
+
 
-    # logging.info(f"Cache miss for map: {cache_key}")
+@lru_cache(maxsize=4096)
+def _gmaps_html_cached(latitude, longitude, elevation):
+    return generate_gmaps_html(latitude, longitude, elevation)
+
+
+def get_map_html(latitude, longitude, elevation):
+    """Map HTML memoized on coordinates rounded to ~100 m."""
+    if elevation is not None:
+        elevation = round(elevation, 1)
+    return _gmaps_html_cached(round(latitude, 3), round(longitude, 3), elevation)
+
+
+def create_map(latitude, longitude):
     elevation = get_elevation(latitude, longitude)
-    map_html = generate_gmaps_html(latitude, longitude, elevation)
-    # cache.set(cache_key, map_html, expire=86400)  # Cache for 24 hours
-    return map_html
+    return get_map_html(latitude, longitude, elevation)
+
+
+@lru_cache(maxsize=1024)
+def read_tile(tile_path):
+    """PNG bytes and ETag for a tile; the hot set of a few MB stays in memory."""
+    # Read whole with one os.read: tiles are small and read once, so skip io's buffering
+    fd = os.open(tile_path, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+        data = os.read(fd, st.st_size)
+    finally:
+        os.close(fd)
+    # Re-tiling rewrites the file, so mtime and size change with its content
+    return data, f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match check per RFC 9110: any listed tag, compared weakly, or "*"."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison ignores W/, which proxies such as nginx add when they gzip
+    opaque = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(",")
+    )
+
+
+@app.get("/map")
+def get_map(lat: float, lng: float, elev: str = None):
+    """The map page on its own, so / can point an iframe at it instead of inlining it.
+
+    / passes the elevation it already looked up (empty when unknown), so the two
+    agree; without elev the point is looked up here.
+    """
+    # Range checks are False for nan and inf, which floor() would choke on later
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return Response(
+            status_code=400, content="lat must be within ±90 and lng within ±180"
+        )
+
+    if elev is None:
+        map_html = create_map(lat, lng)
+    else:
+        try:
+            elevation = float(elev) if elev else None
+        except ValueError:
+            elevation = math.nan
+        if elevation is not None and not math.isfinite(elevation):
+            return Response(status_code=400, content="elev must be a finite number")
+        map_html = get_map_html(lat, lng, elevation)
+
+    return Response(
+        map_html,
+        media_type="text/html",
+        headers={"Cache-Control": MAP_CACHE_CONTROL},
+    )
 
 
 @app.get("/tiles/{z}/{x}/{y}")
-def get_tile(z: int, x: int, y: int):
-    if z not in ALLOWED_ZOOM_LEVELS:
+def get_tile(request, z: int, x: int, y: int):
+    if z not in ALLOWED_ZOOM_SET:
         return Response(
             status_code=404,
             content=f"Only zoom levels {ALLOWED_ZOOM_LEVELS} are available",
         )
 
-    # Fast lookup using nested dictionary
-    if z in tile_index and x in tile_index[z] and y in tile_index[z][x]:
-        tif_dir = tile_index[z][x][y]
-        tile_path = os.path.join(TILES_DIR, tif_dir, str(z), str(x), f"{y}.png")
-        return FileResponse(tile_path, media_type="image/png")
+    # Paths are whitelisted at startup, so a single lookup is all we need.
+    # Out-of-range x/y would spill into another tile's key bits.
+    n = 1 << z
+    tile_path = tile_index.get(tile_key(z, x, y)) if 0 <= x < n and 0 <= y < n else None
+    if tile_path is not None:
+        data, etag = read_tile(tile_path)
+        headers = {"Cache-Control": TILE_CACHE_CONTROL, "ETag": etag}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        return Response(data, media_type="image/png", headers=headers)
 
     return Response(status_code=404, content=f"Tile not found: z={z}, x={x}, y={y}")
 
 
 @rt("/")
-def get_root(request):
+async def get_root(request):
     logging.info("==== Running route / ====")
 
     if DEBUG_MODE:
@@ -406,7 +830,7 @@ def get_root(request):
     else:
         user_ip = request.client.host if request.client else "Unknown"
 
-    location = get_location_info(user_ip)
+    location = await get_location_info(user_ip)
     elevation = get_elevation(location.latitude, location.longitude)
 
     latitude = location.latitude
@@ -415,10 +839,13 @@ def get_root(request):
     state = location.region
     country = location.country
 
-    map_html = ""
+    # Rounded as in get_map_html, so nearby visitors share a URL the browser can cache
+    map_src = "about:blank"
     if latitude is not None and longitude is not None:
-        map_html = generate_gmaps_html(latitude, longitude, elevation)
-        x, y = lat_lon_to_tile(latitude, longitude, ALLOWED_ZOOM_LEVELS[0])
+        elev_param = "" if elevation is None else round(elevation, 1)
+        map_src = (
+            f"/map?lat={round(latitude, 3)}&lng={round(longitude, 3)}&elev={elev_param}"
+        )
 
     if latitude is None:
         latitude = "Unknown"
@@ -446,16 +873,21 @@ def get_root(request):
                     ),
                 ),
             ),
-            Card(H2("Map"), Iframe(srcdoc=map_html, width="100%", height=MAP_HEIGHT)),
+            Card(H2("Map"), Iframe(src=map_src, width="100%", height=MAP_HEIGHT)),
         ),
     )
     return content
 
 if __name__ == "__main__":
+    # Done here, before the workers exist, so they only ever map finished files
+    prepare_dem_cache()
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=5001,
         reload=False,
+        workers=WORKERS,
+        loop="uvloop",
+        http="httptools",
         log_config=None,
     )
\ No newline at end of file
@@ -288,14 +288,15 @@ def analyze_coverage(input_dir, output_dir):
     output_coverage = []
     
     if os.path.exists(tiles_dir):
-        zoom_levels = [int(d) for d in os.listdir(tiles_dir) 
-                      if os.path.isdir(os.path.join(tiles_dir, d))]
+        # scandir entries carry their type, so listing a level needs no stat per entry
+        with os.scandir(tiles_dir) as it:
+            zoom_levels = [int(e.name) for e in it if e.name.isdigit() and e.is_dir()]
         
         logging.info(f"\nAnalyzing tiles for zoom levels: {zoom_levels}")
         for z in zoom_levels:
             zoom_dir = os.path.join(tiles_dir, str(z))
-            x_coords = [int(d) for d in os.listdir(zoom_dir) 
-                       if os.path.isdir(os.path.join(zoom_dir, d))]
+            with os.scandir(zoom_dir) as it:
+                x_coords = [int(e.name) for e in it if e.name.isdigit() and e.is_dir()]
             
             if not x_coords:
                 continue
@@ -306,8 +307,11 @@ def analyze_coverage(input_dir, output_dir):
             # Find y bounds by checking all x directories
             y_coords = []
             for x in x_coords:
-                y_files = glob.glob(os.path.join(zoom_dir, str(x), "*.png"))
-                y_coords.extend([int(os.path.basename(f).split('.')[0]) for f in y_files])
+                with os.scandir(os.path.join(zoom_dir, str(x))) as it:
+                    y_coords.extend(
+                        int(e.name[:-4]) for e in it
+                        if e.name.endswith(".png") and e.name[:-4].isdigit()
+                    )
             
             if y_coords:
                 min_y, max_y = min(y_coords), max(y_coords)